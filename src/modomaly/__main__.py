@@ -1,16 +1,29 @@
 
-import datetime 
+import hashlib
 import logging
 import modomaly 
 import os
+import pickle
+import tempfile
 
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg') # figures are only saved, workers must not open windows
 import matplotlib.pyplot as plt
 import networkx as nx
+import numpy as np
 import pandas as pd 
 
-from statistics import mean, median
-
 TEST_DATA_LOCATION=os.path.join("data")
+EVENTS=[0,2,10,17,41]
+CACHE_LOCATION=os.path.join("out", "cache")
+CACHE_VERSION=1 # bump when graph construction, partitioning or the cached data layout changes
+GRAPH_PARAMS={'xgap': 0.3, 'ygap': 30.0, 'epsilon': 0.6}
+PARTITION_ALG='leiden'
+DATETIME_FORMAT='%Y-%m-%d %H:%M:%S.%f'
+PART_COLORS=False # plot each part in its own color from COLOR instead of all blue
+COLOR=['tab:blue', 'tab:orange', 'tab:green', 'tab:purple', 'tab:brown', 'tab:pink', 'tab:gray', 'tab:olive', 'tab:cyan']
 
 # Get the root logger
 logger = logging.getLogger(__name__)
@@ -21,28 +34,35 @@ logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         # handlers=[logging.StreamHandler()]
 )
-logger.info("'Main' started")
 
-n = len(os.listdir(TEST_DATA_LOCATION))
+def get_partition_info(k):
+    """
+    Return the times and values of each part of the partition of event `k`.
 
-for k in [0,2,10,17,41]:
-    
-    TEST_FILENAME="lidar_"+str(k)+".csv" # each file is one excerpt containing an overtake
-    COLOR=['tab:blue', 'tab:orange', 'tab:green', 'tab:purple', 'tab:brown', 'tab:pink', 'tab:gray', 'tab:olive', 'tab:cyan']
+    Results are pickled to CACHE_LOCATION, keyed by CACHE_VERSION, the event
+    file, its modification time, GRAPH_PARAMS and PARTITION_ALG, so re-runs
+    skip graph construction.
+    """
 
-    logger.info("{}: Processing event".format(k))
+    TEST_FILENAME="lidar_"+str(k)+".csv" # each file is one excerpt containing an overtake
+    path = os.path.join(TEST_DATA_LOCATION, TEST_FILENAME)
+    key = repr((CACHE_VERSION, TEST_FILENAME, os.path.getmtime(path), sorted(GRAPH_PARAMS.items()), PARTITION_ALG))
+    cache_path = os.path.join(CACHE_LOCATION, "lidar_{}-{}.pkl".format(k, hashlib.sha1(key.encode()).hexdigest()[:16]))
+    if os.path.exists(cache_path):
+        logger.info("%s: Loading cached partition", k)
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
 
     # --------------------------------- PARTITIONING ---------------------------------
-    df = pd.read_csv(os.path.join(TEST_DATA_LOCATION, TEST_FILENAME))
-    df['values'] = df['distance'].fillna(0).astype(int)
-    df['datetimestr'] = df[['date', 'time']].apply(lambda x: ' '.join(x), axis=1)
-    df['datetime'] = pd.to_datetime(df['datetimestr'], format='%Y-%m-%d %H:%M:%S.%f')
-    df['unix_time'] = df['datetime'].apply(lambda x: datetime.datetime.timestamp(x))
+    df = pd.read_csv(path, usecols=['date', 'time', 'distance'], dtype={'distance': 'float32'})
+    df['values'] = df['distance'].fillna(0).astype('int32')
+    df['datetime'] = pd.to_datetime(df.pop('date').str.cat(df.pop('time'), sep=' '), format=DATETIME_FORMAT, cache=True)
+    df['unix_time'] = (df['datetime'] - pd.Timestamp(0)).dt.total_seconds()
 
     # Call modularity based module functions
-    G = modomaly.make_components(df) # using the edge-nonedge version of graph construction 
+    G = modomaly.make_components(df, **GRAPH_PARAMS) # using the edge-nonedge version of graph construction 
     # G = modomaly.make_nx_graph(df) # using the weighted version of graph construction
-    P, m = modomaly.get_partition(G)
+    P, m = modomaly.get_partition(G, alg=PARTITION_ALG)
     
     # Try spectral method
     # so = nx.spectral_ordering(G)
@@ -50,15 +70,39 @@ for k in [0,2,10,17,41]:
     # cc = list(nx.connected_components(G))
     # eL = nx.laplacian_spectrum(G)
     # print(len(cc))
-    
-    # ---------------------------------- OUTPUT ------------------------------------
-    logger.info("{}: Plotting figures".format(k))
+
     partition_info = []
+    t_arr = df['unix_time'].to_numpy()
+    v_arr = df['values'].to_numpy()
 
     for p in P: # part in Partition
-        p = list(p)
-        partition_info.append({'times': list(df.iloc[p]['unix_time']), 'values': list(df.iloc[p]['values'])})
+        p = np.asarray(list(p), dtype=np.intp)
+        partition_info.append({'times': t_arr[p], 'values': v_arr[p]})
+
+    # write to a temporary file first, so that an interrupted dump never
+    # leaves a truncated pickle behind at cache_path
+    os.makedirs(CACHE_LOCATION, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=CACHE_LOCATION, suffix=".tmp", delete=False) as f:
+        try:
+            pickle.dump(partition_info, f)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, cache_path)
+
+    return partition_info
+
+def process_file(k):
+    """
+    Partition event `k` and plot the result. Return the path of the plot.
+    """
+
+    logger.info("%s: Processing event", k)
+    partition_info = get_partition_info(k)
     
+    # ---------------------------------- OUTPUT ------------------------------------
+    logger.info("%s: Plotting figures", k)
     # plot each partition in different color
     # for i, p in enumerate(partition_info):
     #     c = COLOR[i%len(COLOR)]
@@ -66,19 +110,16 @@ for k in [0,2,10,17,41]:
     # plt.savefig(os.path.join("out", "lidar_"+str(k)+".png"))
     # plt.clf()
     
+    times = np.concatenate([p['times'] for p in partition_info])
+    values = np.concatenate([p['values'] for p in partition_info])
+    part_sizes = np.array([len(p['values']) for p in partition_info])
+
+    # mean of every part in one pass over the concatenated values
+    part_means = np.add.reduceat(values, np.cumsum(part_sizes) - part_sizes) / part_sizes
+
     # plot biggest low partition in red, rest in blue
-    low_parts = []
-    for i, p in enumerate(partition_info):
-        if mean(p['values']) < 520:
-           low_parts.append(i)
-
-    max_len = 0
-    max_i = 0
-    for i in low_parts:
-        n = len(partition_info[i]['values'])
-        if n > max_len:
-            max_len = n
-            max_i = i
+    # (first biggest if tied, part 0 if there is no low part)
+    max_i = int(np.where(part_means < 520, part_sizes, 0).argmax())
     
     # for i, p in enumerate(partition_info):
     #     c = 'blue'
@@ -88,25 +129,38 @@ for k in [0,2,10,17,41]:
     
     the_part_vals = partition_info[max_i]['values']
     the_part_indx = partition_info[max_i]['times']
-    m = median(the_part_vals) 
-    slim_part_vals = []
-    slim_part_indx = []
-    for i, v in enumerate(the_part_vals):
-        if abs(v-m) < 0.08*m:
-            slim_part_vals.append(v)
-            slim_part_indx.append(the_part_indx[i])
+    m = np.median(the_part_vals) 
+    slim = np.abs(the_part_vals - m) < 0.08*m
+    slim_part_vals = the_part_vals[slim]
+    slim_part_indx = the_part_indx[slim]
     
-    for i, p in enumerate(partition_info):
-        plt.scatter(p['times'], p['values'], color='blue')
-    plt.scatter(slim_part_indx, slim_part_vals, color='red')
+    # all parts go into a single scatter call, one color per part
+    if PART_COLORS:
+        part_colors = np.array(COLOR)[np.arange(len(partition_info)) % len(COLOR)]
+    else:
+        part_colors = np.full(len(partition_info), 'blue')
+    colors = np.repeat(part_colors, part_sizes)
+
+    fig, ax = plt.subplots()
+    ax.scatter(np.concatenate((times, slim_part_indx)),
+               np.concatenate((values, slim_part_vals)),
+               c=np.concatenate((colors, ['red']*len(slim_part_vals))))
+    fig.savefig(os.path.join("out", "weighted-edges", "lidar_"+str(k)+"_weighted_cleaned.png"), dpi=100)
+    plt.close(fig)
+
+    fig, ax = plt.subplots()
+    ax.scatter(times, values, c=colors)
+    out_path = os.path.join("out", "weighted-edges", "lidar_"+str(k)+".png")
+    fig.savefig(out_path, dpi=100)
+    plt.close(fig)
+
+    return out_path
 
-    plt.savefig(os.path.join("out", "weighted-edges", "lidar_"+str(k)+"_weighted_cleaned.png"))
-    plt.clf()
+if __name__ == "__main__":
+    logger.info("'Main' started")
 
-    for i, p in enumerate(partition_info):
-        c = 'blue' # COLOR[i%len(COLOR)]
-        plt.scatter(p['times'], p['values'], color=c)
-    plt.savefig(os.path.join("out", "weighted-edges", "lidar_"+str(k)+".png"))
-    plt.clf()
+    with ProcessPoolExecutor(max_workers=min(len(EVENTS), os.cpu_count() or 1)) as executor:
+        for out_path in executor.map(process_file, EVENTS):
+            logger.info("Saved %s", out_path)
 
-logger.info("'Main' finished")
+    logger.info("'Main' finished")
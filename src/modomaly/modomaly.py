@@ -23,13 +23,65 @@ import leidenalg as la
 import networkx as nx 
 import numpy as np
 import pandas as pd 
+import scipy.sparse as sp
 import matplotlib.pyplot as plt
 
+from numba import njit
+
 modlog = logging.getLogger(__name__)
 
+@njit(cache=True, parallel=False)
+def _build_edges(x, y, xgap, ygap, epsilon):
+    """
+    Return two int32 arrays with the endpoints of the edges of the graph
+    constructed by `make_components`, in the order they are placed.
+
+    The time series `x` must be sorted. For every vertex, the latest time
+    among its neighbors so far is kept in `reach`, so the second-order
+    closeness test is a single comparison, and the scan over `j` stops as
+    soon as node j is too far in time from both i and its latest neighbor,
+    which makes the construction O(n*k) for k nodes within reach of i.
+    """
+
+    n = len(x)
+    reach = np.full(n, -np.inf)
+    cap = 16*n + 16
+    i_arr = np.empty(cap, dtype=np.int32)
+    j_arr = np.empty(cap, dtype=np.int32)
+    m = 0
+
+    eps_xgap = epsilon*xgap
+    for i in range(n-1):
+        xi = x[i]
+        yi = y[i]
+        reach_i = reach[i]
+        for j in range(i+1,n):
+            xj = x[j]
+            # nodes apart more than xgap and node j not close to any neighbor
+            # of i; as x is sorted, neither holds for any later node either.
+            # Written as a negation so that a NaN time (sorted last) also
+            # stops the scan, as NaN never compares close.
+            if not (xj-xi < xgap or xj-reach_i < eps_xgap):
+                break
+            # place edge if nodes apart no more than ygap
+            if abs(yi-y[j]) < ygap:
+                if m == cap:
+                    i_arr = np.concatenate((i_arr, np.empty(cap, dtype=np.int32)))
+                    j_arr = np.concatenate((j_arr, np.empty(cap, dtype=np.int32)))
+                    cap *= 2
+                i_arr[m] = i
+                j_arr[m] = j
+                m += 1
+                # as x is sorted, j and i are now the latest neighbors of i
+                # and j, respectively
+                reach_i = xj
+                reach[j] = xi
+
+    return i_arr[:m], j_arr[:m]
+
 def make_components(df, xgap=0.3, ygap=30.0, epsilon=0.6):
     """
-    Return a networx Graph instance based on the time series in the dataframe.
+    Return an igraph Graph instance based on the time series in the dataframe.
 
     Parameters
     ----------
@@ -47,38 +99,33 @@ def make_components(df, xgap=0.3, ygap=30.0, epsilon=0.6):
     
     Returns
     -------
-    G : networkx.Graph
+    G : igraph.Graph
+
+    Notes
+    -----
+    Vertices are visited in time order, whatever the order of the rows. For
+    a DataFrame already sorted by `unix_time` this places the same edges as
+    visiting the rows in DataFrame order; for unsorted input the graph
+    generally differs, as the second-order rule depends on the visiting
+    order.
     """
     
     # a reasonable xgap for OTs is 20 lines at 50Hz, so pass xgap=0.4. 
-    x = list(df['unix_time'])
-    y = list(df['values'])
+    x = np.asarray(df['unix_time'].values, dtype=np.float64)
+    y = np.asarray(df['values'].values, dtype=np.int32)
     n = len(x)
 
-    edges = [(i,j) for i in range(n-1) for j in range(i+1, n)]
-
     modlog.info("Constructing graph G")
-    G = nx.Graph()
-    G.add_nodes_from(range(n))
-    
-    for i in range(n-1):
-        for j in range(i+1,n):
-            # weigh edge 1 if:
-            # nodes apart no more than ygap 
-            if abs(y[i]-y[j]) < ygap:
-                # nodes apart no more than xgap
-                if abs(x[j]-x[i]) < xgap: 
-                    w = 1
-                # or node j is close to at least one neighbor x of i
-                elif len([v for v in G.neighbors(i) if x[j]-x[v] < epsilon*xgap]) > 0:
-                    w = 1   # weigh edge 1
-                else:
-                    w = 0   # weigh edge 0 
-            else:
-                w = 0
-            if w > 0:
-                G.add_edge(i,j)
-    
+    # the edge kernel scans nodes in time order
+    order = np.argsort(x, kind='stable')
+    i_idx, j_idx = _build_edges(x[order], y[order], xgap, ygap, epsilon)
+    i_idx, j_idx = order[i_idx], order[j_idx]
+    weights = np.ones(len(i_idx))
+
+    # all edges and their weights are handed to igraph in a single call
+    G = ig.Graph(n=n, edges=np.column_stack((i_idx, j_idx)).tolist(), directed=False,
+                 edge_attrs={'weight': weights.tolist()})
+
     modlog.info("Done constructing graph G")
     return G
 
@@ -102,11 +149,9 @@ def make_nx_graph(df, alpha=1.7, c=100):
 
     # a reasonable xgap for OTs is 20 lines at 50Hz, so pass xgap=0.4. 
     x = list(df['unix_time'])
-    y = list(df['values'])
+    y = np.asarray(df['values'].values, dtype=np.float64)
     n = len(x)
 
-    edges = [(i,j) for i in range(n-1) for j in range(i+1, n)]
-
     modlog.info("Constructing graph G")
     G = nx.Graph()
     pos = {}
@@ -116,16 +161,16 @@ def make_nx_graph(df, alpha=1.7, c=100):
     
     x0 = x[0]
 
-    for i in range(n-1):
-        for j in range(i+1,n):
-            # weigh edge 1 if:
-            # nodes apart no more than ygap 
-            
-            # w = (100/np.linalg.norm(np.array([x[i], y[i]]) - np.array([x[j], y[j]]), 2)**1.5)
-            w = (100/np.linalg.norm(np.array([i*5, y[i]]) - np.array([j*5, y[j]]), 2)**1.7) # on x-axis take order instead of values (unix time) for better fit with y-axis scale
-            # print(w, flush=True)
-
-            G.add_edge(i,j, weight=w, resolution=0.1)
+    # on x-axis take order instead of values (unix time) for better fit with y-axis scale
+    ix = np.arange(n)*5.0
+    dist = np.hypot(ix[:, None] - ix[None, :], y[:, None] - y[None, :])
+    # w = c/dist**alpha for every pair; the diagonal (dist 0) is never used
+    with np.errstate(divide='ignore'):
+        W = c/dist**alpha
+    np.fill_diagonal(W, 0)
+
+    iu, ju = np.triu_indices(n, 1)
+    G.add_weighted_edges_from(zip(iu.tolist(), ju.tolist(), W[iu, ju].tolist()), resolution=0.1)
    
     # for e in G.edges(data=True):
     #     if 57 in e:
@@ -140,7 +185,7 @@ def make_nx_graph(df, alpha=1.7, c=100):
     return G
 
 
-def make_ig_graph(df, xgap=0.4, ygap=40.0, epsilon=1.0):
+def make_ig_graph(df, xgap=0.4, ygap=40.0, epsilon=1.0, cutoff=None):
     """
     Return an igraph Graph instance based on the time series in the dataframe.
 
@@ -157,6 +202,11 @@ def make_ig_graph(df, xgap=0.4, ygap=40.0, epsilon=1.0):
     epsilon : float
         Small quantity specifing a fraction of xgap used to determine
         second-order closeness between two vertices. Default is 1.0.
+    cutoff : optional float
+        Pairs of points at euclidean distance `cutoff` or more are not joined
+        by an edge, which keeps the weight matrix sparse. Default is None,
+        i.e. all pairs are joined and the matrix is in effect dense; pass a
+        cutoff to get the memory savings of the sparse construction.
     
     Returns
     -------
@@ -164,48 +214,52 @@ def make_ig_graph(df, xgap=0.4, ygap=40.0, epsilon=1.0):
     """
 
     # a reasonable xgap for OTs is 20 lines at 50Hz, so pass xgap=0.4. 
-    x = list(df['unix_time'])
-    y = list(df['values'])
-    print([i for i in range(len(y)) if y[i] < 400])
+    # float32 is enough once times are taken relative to the first sample
+    x = df['unix_time'].to_numpy(dtype=np.float64)
+    x = (x - x[0]).astype(np.float32)
+    y = df['values'].to_numpy().astype(np.float32)
     n = len(x)
 
-    edges = [[i,j] for i in range(n-1) for j in range(i+1, n)]
-
     modlog.info("Constructing graph G")
-    G = ig.Graph()
-    pos = {}
-    for i in range(n):
-        pos[i] = (i, y[i])
-    G.add_vertices(len(pos.keys()))
-    weights = []
-    edges = []
-
+    # one row of the upper triangle at a time, thresholded right away, so no
+    # pairwise array is ever held in memory
+    rows = [np.empty(0, dtype=np.int32)]
+    cols = [np.empty(0, dtype=np.int32)]
+    weights = [np.empty(0, dtype=np.float32)]
     for i in range(n-1):
-        for j in range(i+1,n):
-            
-            w = (100/np.linalg.norm(np.array([x[i], y[i]]) - np.array([x[j], y[j]]), 2)**1.5)
+        dist = np.hypot(x[i+1:] - x[i], y[i+1:] - y[i])
+        if cutoff is None:
+            j = np.arange(i+1, n, dtype=np.int32)
+        else:
+            j = (np.flatnonzero(dist < cutoff) + (i+1)).astype(np.int32)
+            dist = dist[j - (i+1)]
+        rows.append(np.full(len(j), i, dtype=np.int32))
+        cols.append(j)
+        weights.append(100/dist**1.5)
 
-            edges.add((i,j))
-            weights.add(w)
-    
-    G.add_edges(edges)
-    G.es['weight'] = weights
+    A = sp.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+    G = ig.Graph.Weighted_Adjacency(A, mode='upper')
 
-def get_partition(G, alg="louvain"):
+    modlog.info("Done constructing graph G")
+    return G
+
+def get_partition(G, alg="leiden"):
     """
     Return a 2-tuple containing the list of communities and the modularity
     score.
 
     Parameters
     ----------
-    G : networkx.Graph 
-        Graph instance to be partitioned into communities.
+    G : igraph.Graph or networkx.Graph
+        Graph instance to be partitioned into communities. A networkx graph is
+        converted to igraph first and its communities are reported in terms of
+        its own node labels.
     alg : optional str 
-        Name of the algorithm to use. Currently limited to 'louvain'.
+        Name of the algorithm to use. Either 'leiden' (default) or 'louvain'.
     
     Returns
     -------
-    communities : list of lists of (int or float)
+    communities : list of lists of int (or node labels of a networkx graph)
         List of subsets of vertices that correspond to communities in the graph.
     modularith : float
         Modularity score of the graph partition.
@@ -216,27 +270,35 @@ def get_partition(G, alg="louvain"):
 
     # TODO: use 'resolution' parameter of the louvain algorithm
 
+    if isinstance(G, nx.Graph):
+        G = ig.Graph.from_networkx(G)
+    weights = 'weight' if 'weight' in G.es.attributes() else None
+
     communities = []
     modularity = 0
-    if len(G.edges) == 0:
+    if G.ecount() == 0:
         modlog.error("Graph G has 0 edges. Cannot construct a valid partition.")
         communities = []
         modularity = 0
     else:
-        if alg == "louvain":
-            modlog.info("Partitioning G via 'louvain'")
-            communities = nx.community.louvain_communities(G, weight='weight')
-            modularity = nx.community.modularity(G, communities)
-            modlog.info("Done partitioning G")
-        elif alg == "leiden":
+        if alg == "leiden":
             modlog.info("Partitioning G via 'leiden'")
             partition = la.find_partition(G, la.ModularityVertexPartition, weights=weights)
+            communities = list(partition)
+            modularity = G.modularity(partition.membership, weights=weights)
+            modlog.info("Done partitioning G")
+        elif alg == "louvain":
+            modlog.info("Partitioning G via 'louvain'")
+            partition = G.community_multilevel(weights=weights)
+            communities = list(partition)
             modularity = partition.modularity
             modlog.info("Done partitioning G")
-
         else:
-            modlog.exception(NotImplementedError("Only 'louvain' community detection method implemented at this point"))
+            modlog.exception(NotImplementedError("Only 'leiden' and 'louvain' community detection methods implemented at this point"))
+
+        if '_nx_name' in G.vs.attributes():
+            # map igraph vertex indices back to the networkx node labels
+            names = G.vs['_nx_name']
+            communities = [[names[v] for v in c] for c in communities]
     
     return (communities, modularity)
-
-